@@ -248,7 +248,7 @@ sleep 30
 docker compose ps
 
 echo "=== Step 8: Install Management Tools ==="
-pip3 install requests dnspython pyotp qrcode
+pip3 install requests aiohttp dnspython pyotp qrcode
 
 # Create management directory
 mkdir -p /opt/mailcow-management
@@ -268,6 +268,12 @@ DEFAULT_TTL = 300
 
 # Mailcow API will be configured after first login
 MAILCOW_API_KEY = None
+
+# API TLS certificates are verified by default.
+# Trust a private CA:
+# MAILCOW_CA_BUNDLE = "/path/to/ca.pem"
+# Or skip verification for a self-signed certificate:
+# MAILCOW_VERIFY_SSL = False
 EOF
 
 echo "=== Step 9: Download Management Scripts ==="
@@ -9,24 +9,128 @@ import sys
 import csv
 import json
 import time
-import requests
+import argparse
+import ssl
+import asyncio
+import aiohttp
 import secrets
 import string
+import contextlib
 from pathlib import Path
 import subprocess
 
 # Import our DNS manager
 sys.path.append('/opt/mailcow-management')
 try:
-    from dns_manager import DNSManager
+    from dns_manager import DNSManager, parse_config
 except ImportError:
     # If running from development, try local import
     try:
-        from scripts.dns_manager import DNSManager
+        from scripts.dns_manager import DNSManager, parse_config
     except ImportError:
         print("Error: dns_manager.py not found. Make sure it's in the same directory or installed.")
         sys.exit(1)
 
+# ReachInbox.ai export format based on the sample CSV
+EXPORT_FIELDNAMES = [
+    'Email', 'First Name', 'Last Name', 'IMAP Username', 'IMAP Password',
+    'IMAP Host', 'IMAP Port', 'SMTP Username', 'SMTP Password',
+    'SMTP Host', 'SMTP Port', 'Daily Limit', 'Warmup Enabled',
+    'Warmup Limit', 'Warmup Increment', 'Tracking Domain',
+    'Warmup Filter Tag', 'Warmup On Weekdays', 'Warmup Open Rate',
+    'Warmup Spam Protection Rate', 'Warmup Mark As Important Rate'
+]
+
+# Fixed export values: Warmup Enabled, Warmup Limit, Warmup Increment
+WARMUP_COLUMNS = ('TRUE', 20, 1)
+
+# Fixed export values: Warmup Filter Tag, Warmup On Weekdays, Warmup Open Rate,
+# Warmup Spam Protection Rate, Warmup Mark As Important Rate
+WARMUP_FILTER_COLUMNS = ('shadow', 'TRUE', 95, 85, 90)
+
+# Input columns every CSV must have; Daily Limit and Tracking Domain are optional
+REQUIRED_COLUMNS = {'Domain', 'Username', 'First Name', 'Last Name'}
+
+def open_input(csv_file_path):
+    """Open the input CSV, reading standard input when the path is '-'"""
+    if csv_file_path == '-':
+        sys.stdin.reconfigure(newline='', encoding='utf-8')
+        return contextlib.nullcontext(sys.stdin)
+    return open(csv_file_path, 'r', newline='', encoding='utf-8')
+
+def export_row(result):
+    """Build an export row, in EXPORT_FIELDNAMES order, for a created mailbox"""
+    email = result['email']
+    password = result['password']
+    return (
+        email, result['first_name'], result['last_name'],
+        email, password, result['imap_host'], result['imap_port'],
+        email, password, result['smtp_host'], result['smtp_port'],
+        result['daily_limit']
+    ) + WARMUP_COLUMNS + (result['tracking_domain'],) + WARMUP_FILTER_COLUMNS
+
+class TokenBucket:
+    """Paces API requests, adapting the rate to the server's rate-limit responses"""
+    
+    def __init__(self, rate, burst, max_wait=60):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a request may be sent"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                wait = (1 - self.tokens) / self.rate
+                if wait > self.max_wait:
+                    # Never stall the run indefinitely on a bogus rate
+                    await asyncio.sleep(self.max_wait)
+                    self.tokens = 0
+                    self.updated = time.monotonic()
+                    return
+                await asyncio.sleep(wait)
+    
+    def adapt(self, status, headers):
+        """Adjust the rate from a response's status and X-RateLimit-* headers"""
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        
+        if status == 429:
+            # Back off and drop any saved-up burst
+            self.rate = max(self.rate / 2, 1)
+            self.tokens = 0
+        elif remaining is not None and reset is not None:
+            try:
+                remaining = float(remaining)
+                reset = float(reset)
+            except ValueError:
+                return
+            # Reset may be an epoch timestamp rather than seconds from now
+            if reset > 1e9:
+                reset = max(reset - time.time(), 0)
+            if reset <= 0:
+                return
+            
+            # Spread what is left of the window evenly over the time until it resets
+            self.rate = min(max(remaining / reset, 1), self.max_rate)
+            if remaining < 1:
+                self.tokens = 0
+        elif 200 <= status < 300:
+            # Recover gradually while the server keeps accepting requests;
+            # errors such as 5xx leave the rate where it is
+            self.rate = min(self.rate + 1, self.max_rate)
+
 class MailcowManager:
     def __init__(self, config_path="/opt/mailcow-management/config.py"):
         self.config = self.load_config(config_path)
@@ -42,56 +146,101 @@ class MailcowManager:
             
         self.dns_manager = DNSManager(config_path)
         
+        # Caps in-flight API calls so concurrent mailbox creation stays
+        # within the per-domain rate limit (rl_value) configured in Mailcow
+        self.api_slots = asyncio.Semaphore(20)
+        
+        # Request pacing, slowed down when Mailcow reports rate limiting
+        self.rate_limiter = TokenBucket(rate=20, burst=20)
+        
+        # Shared HTTP session, opened on first API request
+        self.session = None
+        
+        # API certificates are verified; MAILCOW_CA_BUNDLE trusts a private CA and
+        # MAILCOW_VERIFY_SSL = False skips verification for self-signed setups
+        if str(self.config.get('MAILCOW_VERIFY_SSL')).lower() in ('false', '0', 'no'):
+            self.ssl_context = False
+        else:
+            self.ssl_context = ssl.create_default_context(cafile=self.config.get('MAILCOW_CA_BUNDLE'))
+        
     def load_config(self, config_path):
         """Load configuration from config.py file"""
         if not os.path.exists(config_path):
             print(f"Error: Config file not found at {config_path}")
             sys.exit(1)
             
-        config = {}
-        with open(config_path, 'r') as f:
-            content = f.read()
-            for line in content.split('\n'):
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    key = key.strip()
-                    value = value.strip().strip('"\'')
-                    if value == 'None':
-                        value = None
-                    config[key] = value
-        return config
+        return parse_config(config_path, os.path.getmtime(config_path))
     
     def generate_password(self, length=16):
         """Generate a secure random password"""
         characters = string.ascii_letters + string.digits + "!@#$%^&*"
-        return ''.join(secrets.choice(characters) for _ in range(length))
+        n = len(characters)
+        # Largest multiple of n below 256; higher bytes are rejected so each
+        # character stays equally likely
+        limit = (256 // n) * n
+        
+        password = []
+        while len(password) < length:
+            # One CSPRNG draw per batch rather than one per character
+            for b in secrets.token_bytes(length * 2):
+                if b < limit:
+                    password.append(characters[b % n])
+                    if len(password) == length:
+                        break
+        return ''.join(password)
     
-    def api_request(self, endpoint, method='GET', data=None):
-        """Make API request to Mailcow"""
+    def get_session(self):
+        """Return the shared API session, creating it on first use"""
+        if self.session is None:
+            # One pooled session keeps connections alive across requests;
+            # the API host is resolved once and cached for the whole run
+            connector = aiohttp.TCPConnector(limit=64, limit_per_host=64, ssl=self.ssl_context,
+                                             use_dns_cache=True, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=30),
+                headers={
+                    'X-API-Key': self.api_key,
+                    'Content-Type': 'application/json'
+                }
+            )
+        return self.session
+    
+    async def close(self):
+        """Close the shared API session"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+    
+    async def api_request(self, endpoint, method='GET', data=None):
+        """Make API request to Mailcow, returning (status, parsed JSON body)"""
         url = f"{self.api_url}/{endpoint}"
-        headers = {
-            'X-API-Key': self.api_key,
-            'Content-Type': 'application/json'
-        }
+        
+        if method not in ('GET', 'POST', 'DELETE'):
+            raise ValueError(f"Unsupported method: {method}")
         
         try:
-            if method == 'GET':
-                response = requests.get(url, headers=headers, verify=False, timeout=30)
-            elif method == 'POST':
-                response = requests.post(url, headers=headers, json=data, verify=False, timeout=30)
-            elif method == 'DELETE':
-                response = requests.delete(url, headers=headers, json=data, verify=False, timeout=30)
-            else:
-                raise ValueError(f"Unsupported method: {method}")
-            
-            return response
+            async with self.api_slots:
+                for attempt in range(3):
+                    await self.rate_limiter.acquire()
+                    async with self.get_session().request(method, url, json=data) as response:
+                        self.rate_limiter.adapt(response.status, response.headers)
+                        
+                        # Rate limited: retry once the bucket has slowed down
+                        if response.status == 429 and attempt < 2:
+                            continue
+                        
+                        # Error pages are often HTML; keep the status even without a JSON body
+                        try:
+                            return response.status, await response.json(content_type=None)
+                        except ValueError:
+                            return response.status, None
             
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
             print(f"API request failed: {e}")
-            return None
+            return None, None
     
-    def create_domain(self, domain):
+    async def create_domain(self, domain):
         """Create domain in Mailcow"""
         print(f"Creating domain: {domain}")
         
@@ -110,10 +259,9 @@ class MailcowManager:
             "relay_all_recipients": 0
         }
         
-        response = self.api_request('domain', 'POST', data)
+        status, result = await self.api_request('domain', 'POST', data)
         
-        if response and response.status_code == 200:
-            result = response.json()
+        if status == 200 and result:
             if result[0]['type'] == 'success':
                 print(f"✓ Domain {domain} created successfully")
                 return True
@@ -121,10 +269,10 @@ class MailcowManager:
                 print(f"✗ Failed to create domain {domain}: {result[0]['msg']}")
                 return False
         else:
-            print(f"✗ API error creating domain {domain}: {response.status_code if response else 'No response'}")
+            print(f"✗ API error creating domain {domain}: {status or 'No response'}")
             return False
     
-    def create_mailbox(self, domain, username, first_name, last_name, daily_limit=50):
+    async def create_mailbox(self, domain, username, first_name, last_name, daily_limit=50):
         """Create mailbox in Mailcow"""
         email = f"{username}@{domain}"
         password = self.generate_password()
@@ -144,10 +292,9 @@ class MailcowManager:
             "tls_enforce_out": 0
         }
         
-        response = self.api_request('mailbox', 'POST', data)
+        status, result = await self.api_request('mailbox', 'POST', data)
         
-        if response and response.status_code == 200:
-            result = response.json()
+        if status == 200 and result:
             if result[0]['type'] == 'success':
                 print(f"✓ Mailbox {email} created successfully")
                 return {
@@ -161,19 +308,19 @@ class MailcowManager:
                 print(f"✗ Failed to create mailbox {email}: {result[0]['msg']}")
                 return None
         else:
-            print(f"✗ API error creating mailbox {email}: {response.status_code if response else 'No response'}")
+            print(f"✗ API error creating mailbox {email}: {status or 'No response'}")
             return None
     
-    def get_dkim_key(self, domain):
+    async def get_dkim_key(self, domain):
         """Get DKIM public key for domain"""
         print(f"Retrieving DKIM key for {domain}")
         
-        response = self.api_request(f'dkim/{domain}')
+        status, result = await self.api_request(f'dkim/{domain}')
         
-        if response and response.status_code == 200:
-            result = response.json()
+        if status == 200:
             if result and len(result) > 0:
-                dkim_data = result[0]
+                # Mailcow returns a single object; older responses wrap it in a list
+                dkim_data = result if isinstance(result, dict) else result[0]
                 if 'pubkey' in dkim_data:
                     print(f"✓ Retrieved DKIM key for {domain}")
                     return dkim_data['pubkey']
@@ -184,159 +331,233 @@ class MailcowManager:
                 print(f"✗ No DKIM data found for {domain}")
                 return None
         else:
-            print(f"✗ API error retrieving DKIM for {domain}: {response.status_code if response else 'No response'}")
+            print(f"✗ API error retrieving DKIM for {domain}: {status or 'No response'}")
             return None
     
-    def process_csv(self, csv_file_path):
-        """Process CSV file and create domains/mailboxes"""
-        if not os.path.exists(csv_file_path):
+    async def poll_dkim(self, domain, attempts=5):
+        """Fetch a domain's DKIM key, backing off exponentially until it is available"""
+        delay = 1
+        for attempt in range(attempts):
+            try:
+                dkim_key = await self.get_dkim_key(domain)
+            except Exception as e:
+                # The domain and its mailboxes already exist; DNS just goes without DKIM
+                print(f"Error retrieving DKIM for {domain}: {e}")
+                return None
+            if dkim_key or attempt == attempts - 1:
+                return dkim_key
+            await asyncio.sleep(delay)
+            delay *= 2
+    
+    async def apply_dkim_keys(self, dkim_tasks):
+        """Wait for background DKIM lookups and patch the keys into the staged zones"""
+        dkim_keys = await asyncio.gather(*dkim_tasks.values(), return_exceptions=True)
+        for domain, dkim_key in zip(dkim_tasks, dkim_keys):
+            if isinstance(dkim_key, Exception):
+                print(f"Error retrieving DKIM for {domain}: {dkim_key}")
+            elif dkim_key:
+                await asyncio.to_thread(self.dns_manager.update_dkim_record, domain, dkim_key)
+    
+    async def process_csv(self, csv_file_path, output_file, chunk_size=5000):
+        """Process CSV file and create domains/mailboxes, exporting results chunk by chunk"""
+        if csv_file_path != '-' and not os.path.exists(csv_file_path):
             print(f"Error: CSV file not found: {csv_file_path}")
             return None
         
-        results = []
+        total_created = 0
         domains_created = set()
         
         try:
-            with open(csv_file_path, 'r', newline='', encoding='utf-8') as csvfile:
-                # Try to detect the CSV format
-                sample = csvfile.read(1024)
-                csvfile.seek(0)
+            with open_input(csv_file_path) as csvfile:
+                reader = csv.reader(csvfile)
+                header = next(reader, [])
                 
                 # Check if it looks like our expected format
-                if 'Domain' in sample and 'Username' in sample:
-                    # Our simple format: Domain,Username,First Name,Last Name,Daily Limit,Tracking Domain
-                    reader = csv.DictReader(csvfile)
-                    expected_columns = ['Domain', 'Username', 'First Name', 'Last Name']
-                else:
-                    print("Error: CSV format not recognized. Expected columns: Domain, Username, First Name, Last Name")
-                    return None
+                # Our simple format: Domain,Username,First Name,Last Name,Daily Limit,Tracking Domain
+                if not REQUIRED_COLUMNS.issubset(header):
+                    raise ValueError("CSV format not recognized. Expected columns: Domain, Username, First Name, Last Name")
                 
-                for row_num, row in enumerate(reader, start=2):
-                    try:
-                        domain = row['Domain'].strip().lower()
-                        username = row['Username'].strip().lower()
-                        first_name = row['First Name'].strip()
-                        last_name = row['Last Name'].strip()
-                        daily_limit = int(row.get('Daily Limit', 50))
-                        tracking_domain = row.get('Tracking Domain', f'track.{domain}')
-                        
-                        if not domain or not username:
-                            print(f"Skipping row {row_num}: Missing domain or username")
-                            continue
-                        
-                        # Create domain if not already created
-                        if domain not in domains_created:
-                            if self.create_domain(domain):
-                                domains_created.add(domain)
-                                
-                                # Wait a bit for domain to be ready
-                                time.sleep(2)
-                                
-                                # Get DKIM key
-                                dkim_key = self.get_dkim_key(domain)
-                                
-                                # Create DNS records
-                                self.dns_manager.create_domain_dns(domain, dkim_key)
-                                
-                                # Wait for DNS propagation
-                                time.sleep(1)
-                            else:
-                                print(f"Failed to create domain {domain}, skipping mailboxes")
-                                continue
-                        
-                        # Create mailbox
-                        mailbox_result = self.create_mailbox(domain, username, first_name, last_name, daily_limit)
+                # Resolve column positions once instead of building a dict per row
+                idx = {name: header.index(name)
+                       for name in ('Domain', 'Username', 'First Name', 'Last Name', 'Daily Limit', 'Tracking Domain')
+                       if name in header}
+                
+                # Large buffer so each chunk reaches the file in few writes
+                with open(output_file, 'w', newline='', encoding='utf-8', buffering=1 << 20) as outfile:
+                    writer = csv.writer(outfile)
+                    writer.writerow(EXPORT_FIELDNAMES)
+                    
+                    for rows_by_domain in self.read_chunks(reader, idx, chunk_size):
+                        results, dkim_tasks = await self.process_chunk(rows_by_domain, domains_created)
                         
-                        if mailbox_result:
-                            # Add additional fields for export
-                            mailbox_result.update({
-                                'imap_host': f'mail.{self.ns_base}',
-                                'imap_port': 993,
-                                'smtp_host': f'mail.{self.ns_base}',
-                                'smtp_port': 587,
-                                'tracking_domain': tracking_domain
-                            })
-                            results.append(mailbox_result)
+                        # Write this chunk out before waiting on DKIM or reading the next one
+                        self.export_for_cold_email_append(writer, results)
+                        outfile.flush()
+                        total_created += len(results)
                         
-                        # Small delay to avoid overwhelming the API
-                        time.sleep(0.5)
-                        
-                    except Exception as e:
-                        print(f"Error processing row {row_num}: {e}")
-                        continue
+                        await self.apply_dkim_keys(dkim_tasks)
                         
         except Exception as e:
             print(f"Error reading CSV file: {e}")
-            return None
+            if not total_created:
+                return None
+            
+            # Earlier chunks already exist in Mailcow and are in the export
+            print(f"{total_created} mailboxes were created and exported to {output_file} before the error.")
+            print("Remove those rows from the input before re-running to avoid duplicates.")
         
-        return results
+        return total_created
     
-    def export_for_cold_email(self, results, output_file):
-        """Export results in ReachInbox.ai compatible format"""
-        if not results:
-            print("No results to export")
-            return
+    def read_chunks(self, reader, idx, chunk_size):
+        """Yield parsed rows grouped by domain, at most chunk_size rows at a time"""
+        # Rows grouped by domain, in the order domains first appear
+        rows_by_domain = {}
+        row_count = 0
         
-        print(f"Exporting {len(results)} mailboxes to {output_file}")
+        for row_num, row in enumerate(reader, start=2):
+            if not row:
+                continue
+            
+            try:
+                domain = row[idx['Domain']].strip().lower()
+                username = row[idx['Username']].strip().lower()
+                first_name = row[idx['First Name']].strip()
+                last_name = row[idx['Last Name']].strip()
+                daily_limit = int(row[idx['Daily Limit']]) if 'Daily Limit' in idx else 50
+                tracking_domain = row[idx['Tracking Domain']] if 'Tracking Domain' in idx else f'track.{domain}'
+                
+                if not domain or not username:
+                    print(f"Skipping row {row_num}: Missing domain or username")
+                    continue
+                
+                rows_by_domain.setdefault(domain, []).append(
+                    (row_num, username, first_name, last_name, daily_limit, tracking_domain)
+                )
+                row_count += 1
+                
+            except Exception as e:
+                print(f"Error processing row {row_num}: {e}")
+                continue
+            
+            if row_count >= chunk_size:
+                yield rows_by_domain
+                rows_by_domain = {}
+                row_count = 0
         
-        # ReachInbox.ai format based on the sample CSV
-        fieldnames = [
-            'Email', 'First Name', 'Last Name', 'IMAP Username', 'IMAP Password',
-            'IMAP Host', 'IMAP Port', 'SMTP Username', 'SMTP Password',
-            'SMTP Host', 'SMTP Port', 'Daily Limit', 'Warmup Enabled',
-            'Warmup Limit', 'Warmup Increment', 'Tracking Domain',
-            'Warmup Filter Tag', 'Warmup On Weekdays', 'Warmup Open Rate',
-            'Warmup Spam Protection Rate', 'Warmup Mark As Important Rate'
-        ]
+        if rows_by_domain:
+            yield rows_by_domain
+    
+    async def process_chunk(self, rows_by_domain, domains_created):
+        """Create a chunk's new domains, then its mailboxes while DNS records are written.
         
-        try:
-            with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
+        Returns the created mailboxes and the pending DKIM lookups by domain.
+        """
+        new_domains = []
+        dkim_tasks = {}
+        ready_rows = {}
+        
+        for domain, domain_rows in rows_by_domain.items():
+            # Create domain if not already created
+            if domain not in domains_created:
+                try:
+                    if not await self.create_domain(domain):
+                        print(f"Failed to create domain {domain}, skipping mailboxes")
+                        continue
+                except Exception as e:
+                    print(f"Error processing domain {domain}: {e}, skipping mailboxes")
+                    continue
+                domains_created.add(domain)
                 
-                for result in results:
-                    row = {
-                        'Email': result['email'],
-                        'First Name': result['first_name'],
-                        'Last Name': result['last_name'],
-                        'IMAP Username': result['email'],
-                        'IMAP Password': result['password'],
-                        'IMAP Host': result['imap_host'],
-                        'IMAP Port': result['imap_port'],
-                        'SMTP Username': result['email'],
-                        'SMTP Password': result['password'],
-                        'SMTP Host': result['smtp_host'],
-                        'SMTP Port': result['smtp_port'],
-                        'Daily Limit': result['daily_limit'],
-                        'Warmup Enabled': 'TRUE',
-                        'Warmup Limit': 20,
-                        'Warmup Increment': 1,
-                        'Tracking Domain': result['tracking_domain'],
-                        'Warmup Filter Tag': 'shadow',
-                        'Warmup On Weekdays': 'TRUE',
-                        'Warmup Open Rate': 95,
-                        'Warmup Spam Protection Rate': 85,
-                        'Warmup Mark As Important Rate': 90
-                    }
-                    writer.writerow(row)
+                # Mailcow generates the DKIM key asynchronously; poll for it in
+                # the background and stage the zone without it for now
+                dkim_tasks[domain] = asyncio.create_task(self.poll_dkim(domain))
+                new_domains.append((domain, None))
             
-            print(f"✓ Export completed: {output_file}")
+            ready_rows[domain] = domain_rows
+        
+        # Zone files are written on worker threads while the mailbox requests
+        # are in flight; BIND is reloaded once after the whole run
+        _, *domain_results = await asyncio.gather(
+            asyncio.to_thread(self.dns_manager.stage_all_dns, new_domains),
+            *(self.create_mailboxes(domain, domain_rows) for domain, domain_rows in ready_rows.items())
+        )
+        
+        # DKIM lookups may still be running; the caller applies them once the
+        # chunk's mailboxes are safely exported
+        return [result for results in domain_results for result in results], dkim_tasks
+    
+    async def create_mailboxes(self, domain, domain_rows):
+        """Create all mailboxes for a domain concurrently"""
+        # api_slots paces the fan-out
+        mailbox_results = await asyncio.gather(
+            *(self.create_mailbox(domain, username, first_name, last_name, daily_limit)
+              for _, username, first_name, last_name, daily_limit, _ in domain_rows),
+            return_exceptions=True
+        )
+        
+        results = []
+        for (row_num, *_, tracking_domain), mailbox_result in zip(domain_rows, mailbox_results):
+            if isinstance(mailbox_result, Exception):
+                print(f"Error processing row {row_num}: {mailbox_result}")
+                continue
             
-        except Exception as e:
-            print(f"Error exporting results: {e}")
+            if mailbox_result:
+                # Add additional fields for export
+                mailbox_result.update({
+                    'imap_host': f'mail.{self.ns_base}',
+                    'imap_port': 993,
+                    'smtp_host': f'mail.{self.ns_base}',
+                    'smtp_port': 587,
+                    'tracking_domain': tracking_domain
+                })
+                results.append(mailbox_result)
+        
+        return results
+    
+    def export_for_cold_email_append(self, writer, results):
+        """Append results to an open ReachInbox.ai compatible export"""
+        if not results:
+            return
+        
+        print(f"Exporting {len(results)} mailboxes")
+        
+        writer.writerows(export_row(result) for result in results)
+
+def positive_int(value):
+    """argparse type for options that must be a whole number of at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+async def run_bulk_setup(manager, csv_file, output_file, chunk_size):
+    """Process the CSV, closing the manager's API session when done"""
+    try:
+        return await manager.process_csv(csv_file, output_file, chunk_size)
+    finally:
+        await manager.close()
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python3 bulk-setup.py <csv_file> [output_file]")
-        print("")
-        print("CSV Format:")
-        print("Domain,Username,First Name,Last Name,Daily Limit,Tracking Domain")
-        print("example1.com,john,John,Doe,50,track.example1.com")
-        print("example1.com,jane,Jane,Smith,30,track.example1.com")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description="Create Mailcow domains, mailboxes and DNS records from a CSV file",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="CSV Format:\n"
+               "Domain,Username,First Name,Last Name,Daily Limit,Tracking Domain\n"
+               "example1.com,john,John,Doe,50,track.example1.com\n"
+               "example1.com,jane,Jane,Smith,30,track.example1.com"
+    )
+    parser.add_argument('csv_file', help="input CSV file, or - to read standard input")
+    parser.add_argument('output_file', nargs='?', default='mailboxes_export.csv',
+                        help="export CSV file (default: mailboxes_export.csv)")
+    parser.add_argument('--chunk-size', type=positive_int, default=5000,
+                        help="rows to process before writing them to the export (default: 5000)")
+    args = parser.parse_args()
     
-    csv_file = sys.argv[1]
-    output_file = sys.argv[2] if len(sys.argv) > 2 else 'mailboxes_export.csv'
+    csv_file = args.csv_file
+    output_file = args.output_file
     
     # Check if running on VPS or development
     config_path = "/opt/mailcow-management/config.py"
@@ -352,16 +573,18 @@ def main():
     print(f"Output: {output_file}")
     print("")
     
-    # Process CSV file
-    results = manager.process_csv(csv_file)
+    # Process CSV file, exporting results as each chunk completes
+    total_created = asyncio.run(run_bulk_setup(manager, csv_file, output_file, args.chunk_size))
+    
+    # Load all new zones with a single BIND reload
+    manager.dns_manager.reload_bind()
     
-    if results:
-        # Export results
-        manager.export_for_cold_email(results, output_file)
+    if total_created:
+        print(f"✓ Export completed: {output_file}")
         
         print("")
         print("=== Summary ===")
-        print(f"Total mailboxes created: {len(results)}")
+        print(f"Total mailboxes created: {total_created}")
         print(f"Export file: {output_file}")
         print("")
         print("Next steps:")
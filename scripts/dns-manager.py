@@ -9,58 +9,37 @@ import sys
 import time
 import subprocess
 import re
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-class DNSManager:
-    def __init__(self, config_path="/opt/mailcow-management/config.py"):
-        self.config = self.load_config(config_path)
-        self.bind_config_path = self.config.get('BIND_CONFIG_PATH', '/etc/bind/named.conf.local')
-        self.zones_path = self.config.get('BIND_ZONES_PATH', '/etc/bind')
-        self.vps_ip = self.config.get('VPS_IP')
-        self.ns_base = self.config.get('NS_BASE')
-        self.default_ttl = self.config.get('DEFAULT_TTL', 300)
-        
-    def load_config(self, config_path):
-        """Load configuration from config.py file"""
-        if not os.path.exists(config_path):
-            print(f"Error: Config file not found at {config_path}")
-            sys.exit(1)
-            
-        config = {}
-        with open(config_path, 'r') as f:
-            content = f.read()
-            # Simple config parser - extract key = value pairs
-            for line in content.split('\n'):
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    key = key.strip()
-                    value = value.strip().strip('"\'')
-                    if value == 'None':
-                        value = None
-                    config[key] = value
-        return config
-    
-    def create_zone_file(self, domain, dkim_key=None):
-        """Create BIND9 zone file for a domain"""
-        serial = int(time.time())
-        
-        # Basic zone template
-        zone_content = f"""$TTL    {self.default_ttl}
-@       IN      SOA     ns1.{self.ns_base}. admin.{domain}. (
+# PEM armour and whitespace stripped from DKIM public keys
+_DKIM_STRIP = re.compile(r'-----(?:BEGIN|END) PUBLIC KEY-----|\s+')
+
+# Zone names declared in named.conf.local
+_ZONE_RE = re.compile(r'zone "([^"]+)"')
+
+# A whole zone "<domain>" { ... }; stanza starting at a line, including one
+# level of nested braces such as allow-transfer { any; };
+_ZONE_BLOCK = r'(?m)^zone\s+"{}"\s*\{{(?:[^{{}}]|\{{[^{{}}]*\}})*\}};[ \t]*\n?'
+
+# Basic zone template
+_ZONE_TEMPLATE = """$TTL    {ttl}
+@       IN      SOA     ns1.{ns_base}. admin.{domain}. (
                      {serial}           ; Serial (timestamp)
-                         {self.default_ttl}         ; Refresh
-                         {self.default_ttl}         ; Retry
+                         {ttl}         ; Refresh
+                         {ttl}         ; Retry
                          604800             ; Expire
-                         {self.default_ttl} )       ; Negative Cache TTL
+                         {ttl} )       ; Negative Cache TTL
 
 ; Name servers
-@       IN      NS      ns1.{self.ns_base}.
-@       IN      NS      ns2.{self.ns_base}.
+@       IN      NS      ns1.{ns_base}.
+@       IN      NS      ns2.{ns_base}.
 
 ; Mail server
-@       IN      A       {self.vps_ip}
-mail    IN      A       {self.vps_ip}
+@       IN      A       {vps_ip}
+mail    IN      A       {vps_ip}
 @       IN      MX      10      mail.{domain}.
 
 ; Auto-discovery for mail clients
@@ -68,35 +47,152 @@ autodiscover    IN      CNAME   mail
 autoconfig      IN      CNAME   mail
 
 ; SPF Record
-@       IN      TXT     "v=spf1 ip4:{self.vps_ip} mx ~all"
+@       IN      TXT     "v=spf1 ip4:{vps_ip} mx ~all"
 
 ; DMARC Record
 _dmarc  IN      TXT     "v=DMARC1; p=quarantine; rua=mailto:dmarc@{domain}; ruf=mailto:dmarc@{domain}; fo=1"
+{dkim_block}"""
+
+_DKIM_TXT = 'dkim._domainkey IN      TXT     "v=DKIM1; k=rsa; p={clean_key}"'
+
+_DKIM_RECORD = """
+; DKIM Record
+""" + _DKIM_TXT + """
 """
 
+# Existing DKIM TXT record and SOA serial in a zone file
+_DKIM_LINE_RE = re.compile(r'^dkim\._domainkey\s+IN\s+TXT\s+.*$', re.MULTILINE)
+_SERIAL_RE = re.compile(r'(\d+)(\s+; Serial)')
+
+def _atomic_write(path, data):
+    """Write bytes to path via a temp file and os.replace so BIND never sees a partial file"""
+    # Keep the permissions and ownership of the file being replaced
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+        if st is not None:
+            os.fchmod(fd, st.st_mode & 0o7777)
+            try:
+                os.fchown(fd, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
+@functools.lru_cache(maxsize=4)
+def parse_config(config_path, mtime):
+    """Parse key = value pairs from config.py, cached per path and modification time"""
+    config = {}
+    with open(config_path, 'r') as f:
+        content = f.read()
+        # Simple config parser - extract key = value pairs
+        for line in content.split('\n'):
+            line = line.strip()
+            if line and not line.startswith('#') and '=' in line:
+                key, value = line.split('=', 1)
+                key = key.strip()
+                value = value.strip().strip('"\'')
+                if value == 'None':
+                    value = None
+                config[key] = value
+    return config
+
+class DNSManager:
+    def __init__(self, config_path="/opt/mailcow-management/config.py"):
+        self.config = self.load_config(config_path)
+        self.bind_config_path = self.config.get('BIND_CONFIG_PATH', '/etc/bind/named.conf.local')
+        self.zones_path = self.config.get('BIND_ZONES_PATH', '/etc/bind')
+        self.vps_ip = self.config.get('VPS_IP')
+        self.ns_base = self.config.get('NS_BASE')
+        self.default_ttl = self.config.get('DEFAULT_TTL', 300)
+        self._load_existing_zones()
+        
+        # Serialises appends to named.conf.local when staging in parallel
+        self._config_lock = threading.Lock()
+        
+        # Set whenever zones or the BIND config change; reload_bind is a no-op otherwise
+        self._config_dirty = False
+        
+        # Fill in the per-server values once; only per-domain fields remain
+        self._zone_tmpl = _ZONE_TEMPLATE.format(ttl=self.default_ttl, ns_base=self.ns_base,
+                                                vps_ip=self.vps_ip, domain='{domain}',
+                                                serial='{serial}', dkim_block='{dkim_block}')
+        
+    def load_config(self, config_path):
+        """Load configuration from config.py file"""
+        if not os.path.exists(config_path):
+            print(f"Error: Config file not found at {config_path}")
+            sys.exit(1)
+            
+        return parse_config(config_path, os.path.getmtime(config_path))
+    
+    def _load_existing_zones(self):
+        """Read zone names already in the BIND config so lookups don't rescan the file"""
+        try:
+            with open(self.bind_config_path, 'r') as f:
+                self._zones = set(_ZONE_RE.findall(f.read()))
+        except FileNotFoundError:
+            self._zones = set()
+    
+    def create_zone_file(self, domain, dkim_key=None):
+        """Create BIND9 zone file for a domain"""
         # Add DKIM record if provided
+        dkim_block = ''
         if dkim_key:
             # Clean up DKIM key - remove headers and format properly
-            clean_key = dkim_key.replace('-----BEGIN PUBLIC KEY-----', '')
-            clean_key = clean_key.replace('-----END PUBLIC KEY-----', '')
-            clean_key = ''.join(clean_key.split())
-            
-            zone_content += f"""
-; DKIM Record
-dkim._domainkey IN      TXT     "v=DKIM1; k=rsa; p={clean_key}"
-"""
+            clean_key = _DKIM_STRIP.sub('', dkim_key)
+            dkim_block = _DKIM_RECORD.format(clean_key=clean_key)
+        
+        zone_data = self._zone_tmpl.format(domain=domain, serial=int(time.time()),
+                                           dkim_block=dkim_block).encode('utf-8')
         
         # Write zone file
         zone_file_path = os.path.join(self.zones_path, f'db.{domain}')
         try:
-            with open(zone_file_path, 'w') as f:
-                f.write(zone_content)
+            _atomic_write(zone_file_path, zone_data)
+            self._config_dirty = True
             print(f"Created zone file: {zone_file_path}")
             return True
         except Exception as e:
             print(f"Error creating zone file for {domain}: {e}")
             return False
     
+    def update_dkim_record(self, domain, dkim_key):
+        """Set the DKIM record in an existing zone file, bumping its serial"""
+        zone_file_path = os.path.join(self.zones_path, f'db.{domain}')
+        try:
+            with open(zone_file_path, 'r') as f:
+                zone_content = f.read()
+            
+            dkim_txt = _DKIM_TXT.format(clean_key=_DKIM_STRIP.sub('', dkim_key))
+            zone_content, replaced = _DKIM_LINE_RE.subn(lambda m: dkim_txt, zone_content, count=1)
+            if not replaced:
+                zone_content += '\n; DKIM Record\n' + dkim_txt + '\n'
+            
+            # Secondaries only pick up the change if the serial moves forward
+            zone_content = _SERIAL_RE.sub(
+                lambda m: f"{max(int(m.group(1)) + 1, int(time.time()))}{m.group(2)}",
+                zone_content, count=1
+            )
+            
+            _atomic_write(zone_file_path, zone_content.encode('utf-8'))
+            self._config_dirty = True
+            print(f"Updated DKIM record for {domain}")
+            return True
+        except Exception as e:
+            print(f"Error updating DKIM record for {domain}: {e}")
+            return False
+    
     def add_zone_to_config(self, domain):
         """Add zone configuration to named.conf.local"""
         zone_config = f"""
@@ -108,16 +204,17 @@ zone "{domain}" {{
 """
         
         try:
-            # Check if zone already exists
-            with open(self.bind_config_path, 'r') as f:
-                existing_content = f.read()
-                if f'zone "{domain}"' in existing_content:
+            with self._config_lock:
+                # Check if zone already exists
+                if domain in self._zones:
                     print(f"Zone {domain} already exists in BIND config")
                     return True
-            
-            # Add zone to config
-            with open(self.bind_config_path, 'a') as f:
-                f.write(zone_config)
+                
+                # Add zone to config
+                with open(self.bind_config_path, 'a') as f:
+                    f.write(zone_config)
+                self._zones.add(domain)
+                self._config_dirty = True
             print(f"Added zone {domain} to BIND config")
             return True
         except Exception as e:
@@ -129,22 +226,13 @@ zone "{domain}" {{
         try:
             # Remove from named.conf.local
             with open(self.bind_config_path, 'r') as f:
-                lines = f.readlines()
-            
-            new_lines = []
-            skip_zone = False
+                content = f.read()
             
-            for line in lines:
-                if f'zone "{domain}"' in line:
-                    skip_zone = True
-                elif skip_zone and '};' in line:
-                    skip_zone = False
-                    continue
-                elif not skip_zone:
-                    new_lines.append(line)
+            zone_block = re.compile(_ZONE_BLOCK.format(re.escape(domain)))
             
-            with open(self.bind_config_path, 'w') as f:
-                f.writelines(new_lines)
+            _atomic_write(self.bind_config_path, zone_block.sub('', content).encode('utf-8'))
+            self._zones.discard(domain)
+            self._config_dirty = True
             
             # Remove zone file
             zone_file_path = os.path.join(self.zones_path, f'db.{domain}')
@@ -159,8 +247,12 @@ zone "{domain}" {{
             print(f"Error removing zone {domain}: {e}")
             return False
     
-    def reload_bind(self):
-        """Reload BIND9 configuration"""
+    def reload_bind(self, force=False):
+        """Reload BIND9 configuration if anything changed since the last reload"""
+        if not force and not self._config_dirty:
+            print("No DNS changes, skipping BIND9 reload")
+            return True
+        
         try:
             # Check configuration first
             result = subprocess.run(['named-checkconf'], capture_output=True, text=True)
@@ -168,9 +260,10 @@ zone "{domain}" {{
                 print(f"BIND configuration error: {result.stderr}")
                 return False
             
-            # Reload BIND9
-            result = subprocess.run(['systemctl', 'reload', 'named'], capture_output=True, text=True)
+            # Reload BIND9 directly over rndc rather than through systemd
+            result = subprocess.run(['rndc', 'reload'], capture_output=True, text=True)
             if result.returncode == 0:
+                self._config_dirty = False
                 print("BIND9 reloaded successfully")
                 return True
             else:
@@ -181,8 +274,23 @@ zone "{domain}" {{
             print(f"Error reloading BIND9: {e}")
             return False
     
-    def create_domain_dns(self, domain, dkim_key=None):
-        """Complete DNS setup for a domain"""
+    def reload_zone(self, domain):
+        """Reload a single zone without reloading the rest of BIND9"""
+        try:
+            result = subprocess.run(['rndc', 'reload', domain], capture_output=True, text=True)
+            if result.returncode == 0:
+                print(f"Zone {domain} reloaded successfully")
+                return True
+            else:
+                print(f"Error reloading zone {domain}: {result.stderr}")
+                return False
+                
+        except Exception as e:
+            print(f"Error reloading zone {domain}: {e}")
+            return False
+    
+    def stage_domain_dns(self, domain, dkim_key=None):
+        """Write zone file and BIND config for a domain without reloading BIND"""
         print(f"Creating DNS records for {domain}...")
         
         # Create zone file
@@ -193,6 +301,18 @@ zone "{domain}" {{
         if not self.add_zone_to_config(domain):
             return False
         
+        return True
+    
+    def stage_all_dns(self, domains_and_keys):
+        """Stage DNS for many (domain, dkim_key) pairs, writing zone files in parallel"""
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            return list(executor.map(lambda args: self.stage_domain_dns(*args), domains_and_keys))
+    
+    def create_domain_dns(self, domain, dkim_key=None):
+        """Complete DNS setup for a domain"""
+        if not self.stage_domain_dns(domain, dkim_key):
+            return False
+        
         # Reload BIND
         if not self.reload_bind():
             return False
@@ -207,7 +327,7 @@ zone "{domain}" {{
             with open(self.bind_config_path, 'r') as f:
                 content = f.read()
                 # Extract zone names using regex
-                zone_matches = re.findall(r'zone "([^"]+)"', content)
+                zone_matches = _ZONE_RE.findall(content)
                 zones = [zone for zone in zone_matches if zone != self.ns_base]
             
             print(f"Configured zones ({len(zones)}):")
@@ -241,6 +361,7 @@ def main():
     if len(sys.argv) < 2:
         print("Usage:")
         print("  python3 dns-manager.py create <domain> [dkim_key]")
+        print("  python3 dns-manager.py dkim <domain> <dkim_key>")
         print("  python3 dns-manager.py remove <domain>")
         print("  python3 dns-manager.py list")
         print("  python3 dns-manager.py verify <domain>")
@@ -258,6 +379,15 @@ def main():
         dkim_key = sys.argv[3] if len(sys.argv) > 3 else None
         dns.create_domain_dns(domain, dkim_key)
         
+    elif command == "dkim":
+        if len(sys.argv) < 4:
+            print("Error: Domain and DKIM key required")
+            sys.exit(1)
+        domain = sys.argv[2]
+        dkim_key = sys.argv[3]
+        if dns.update_dkim_record(domain, dkim_key):
+            dns.reload_zone(domain)
+        
     elif command == "remove":
         if len(sys.argv) < 3:
             print("Error: Domain required")
@@ -277,7 +407,7 @@ def main():
         dns.verify_dns(domain)
         
     elif command == "reload":
-        dns.reload_bind()
+        dns.reload_bind(force=True)
         
     else:
         print(f"Unknown command: {command}")